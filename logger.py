@@ -1,5 +1,8 @@
-import inspect
+import atexit
 import logging
+import multiprocessing
+import sys
+from logging.handlers import QueueHandler, QueueListener
 
 from settings import settings
 
@@ -57,27 +60,127 @@ def add_logging_level(level_name, level_num, method_name=None):
 
 
 logging.raiseExceptions = False
-add_logging_level("SPAM", 5)
+if not hasattr(logging, "SPAM"):
+    add_logging_level("SPAM", 5)
+
+
+def caller_name(depth):
+    """Returns the name of the function `depth` frames above the caller, or "<unknown>" if the stack is too shallow"""
+    try:
+        return sys._getframe(depth + 1).f_code.co_name
+    except ValueError:
+        return "<unknown>"
+
+
+def _probe_depth():
+    """Determine how many frames the logging module puts between a logger's filter and the method issuing the log call
+
+    A throwaway logger with a probing filter is called from this function, and the filter counts the frames up to
+    this function's own frame.
+    """
+    depths = []
+
+    class DepthProbe(logging.Filter):
+        def filter(self, record):
+            frame = sys._getframe()
+            depth = 0
+            while frame is not None and frame.f_code is not _probe_depth.__code__:
+                frame = frame.f_back
+                depth += 1
+            depths.append(depth)
+            return False  # drop the probe record
+
+    probe = logging.Logger("depth_probe")
+    probe.addFilter(DepthProbe())
+    probe.critical("probe")
+    return depths[0]
 
 
 class ActionFilter(logging.Filter):
     """Adds the currently running method to the record"""
 
+    # frames between this filter and the method that issued the log call
+    depth = _probe_depth()
+
     def filter(self, record):
         """Adds the currently running method to the record"""
-        record.action = inspect.stack()[5][3]
+        record.action = caller_name(self.depth)
+        return True
+
+
+class RecordActionFilter(logging.Filter):
+    """Adds the function that issued the log call to records that didn't pass an ActionFilter
+
+    Loggers that come to a worker process by pickling are plain loggers without an ActionFilter, but the log file
+    format needs the action. As a handler filter this can't count frames like ActionFilter, so it takes the function
+    name the record already carries.
+    """
+
+    def filter(self, record):
+        if not hasattr(record, "action"):
+            record.action = record.funcName
         return True
 
 
+# background thread writing all log records to disk, so logging calls do not block on file I/O
+_listener = None
+# queue the listener takes the records from, worker processes put their records there as well
+_log_queue = None
+
+
+def _start_listener(filename):
+    """Routes all records of the root logger through a queue to a file handler owned by a listener thread"""
+    global _listener, _log_queue
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(action)s - %(message)s'))
+    # a queue of the fork context can't be handed to spawned processes, one of the spawn context works for all of them
+    _log_queue = multiprocessing.get_context("spawn").Queue(-1)
+    _listener = QueueListener(_log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(_log_queue))
+    root.setLevel(logging.DEBUG)
+
+
+def log_queue():
+    """Returns the queue of the log listener, to be passed to init_worker_logging of worker processes"""
+    return _log_queue
+
+
+def init_worker_logging(log_queue):
+    """Send all records of a worker process to the listener of the process that started it
+
+    Args:
+        log_queue: the queue returned by log_queue in the parent process, nothing is changed if it is None
+    """
+    if log_queue is None:
+        return
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(RecordActionFilter())
+    root.addHandler(queue_handler)
+    root.setLevel(logging.DEBUG)
+
+
+# loggers already set up by init_logger, keyed by (name, module, name of the parent logger)
+_logger_cache = dict()
+
+
 def init_logger(name, module: str = None, log_callback: logging.Logger = None):
+    key = (name, module, None if log_callback is None else log_callback.name)
+    if key in _logger_cache:
+        return _logger_cache[key]
     if log_callback is None:
-        logging.basicConfig(
-                filename=f"{settings['logs_dir']}{name} {module}.log",
-                level=logging.DEBUG,
-                format='%(asctime)s - %(name)s - %(levelname)s - %(action)s - %(message)s')
+        # like logging.basicConfig, only the first top level logger determines the log file
+        if _listener is None:
+            _start_listener(f"{settings['logs_dir']}{name} {module}.log")
         logger = logging.getLogger(module)
     else:
         logger = log_callback.getChild(module)
-    add_action = ActionFilter()
-    logger.addFilter(add_action)
+    if not any(isinstance(log_filter, ActionFilter) for log_filter in logger.filters):
+        logger.addFilter(ActionFilter())
+    _logger_cache[key] = logger
     return logger
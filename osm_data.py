@@ -1,27 +1,95 @@
+import re
+from array import array
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger  # for typing
 from math import sqrt, radians, sin, cos, asin
+from sys import intern
 
-import osmread
+import numpy as np
+import osmium
 
 import logger
 from street_network import StreetNetwork
 
-Coordinate = namedtuple("Coordinate", ["longitude", "latitude"])
+
+# copies of the OSM entities, since osmium only keeps its own objects alive during the handler callbacks
+Node = namedtuple("Node", ["id", "tags"])
+Way = namedtuple("Way", ["id", "tags", "nodes"])
+Relation = namedtuple("Relation", ["id", "tags", "members"])
+RelationMember = namedtuple("RelationMember", ["type", "member_id", "role"])
+
+
+class _OSMHandler(osmium.SimpleHandler):
+    """Copies the entities of an OSM file into a GraphBuilder while libosmium reads the file"""
+
+    def __init__(self, builder):
+        super().__init__()
+        self.builder = builder
+        self.latitudes = array("d")
+        self.longitudes = array("d")
+
+    def node(self, node):
+        # most nodes carry no tags, for those the coordinates are all we need
+        if node.tags:
+            self.builder.all_osm_nodes[node.id] = Node(node.id, self.copy_tags(node.tags))
+        self.builder._node_index[node.id] = len(self.latitudes)
+        self.latitudes.append(node.location.lat)
+        self.longitudes.append(node.location.lon)
+
+    def way(self, way):
+        self.builder.all_osm_ways[way.id] = Way(way.id, self.copy_tags(way.tags),
+                                                [node.ref for node in way.nodes])
+
+    def relation(self, relation):
+        self.builder.all_osm_relations[relation.id] = Relation(
+                relation.id, self.copy_tags(relation.tags),
+                [RelationMember(member.type, member.ref, member.role) for member in relation.members])
+
+    @staticmethod
+    def copy_tags(tags):
+        """Copy osmium tags into a dict, sharing a single string object for each distinct key"""
+        return {intern(tag.k): tag.v for tag in tags}
+
+
+# matches the maxspeed tag values we understand: "50", "30 mph", "none"
+MAX_SPEED_EXPRESSION = re.compile(r"^\s*(?:(\d+)\s*(mph)?|(none))\s*$")
+
+
+def parse_max_speed(max_speed_tag, default):
+    """Convert the value of an OSM maxspeed tag to km/h, returning default for values that are not understood"""
+    match = MAX_SPEED_EXPRESSION.match(max_speed_tag)
+    if match is None:
+        return default
+    speed, mph, none = match.groups()
+    if none is not None:
+        return 140
+    if mph is not None:
+        return round(int(speed) * 1.609344)
+    return int(speed)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance in m between two points given in degrees, using the haversine formula, which incorporates earth
+    curvature. See http://en.wikipedia.org/wiki/Haversine_formula"""
+    lat1 = radians(lat1)
+    lat2 = radians(lat2)
+    delta_lon = radians(lon2 - lon1)
+    delta_lat = lat2 - lat1
+    a = sin(delta_lat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(delta_lon / 2) ** 2
+    c = 2 * asin(sqrt(a))
+    return 6367000 * c  # return distance in m
 
 
 class GraphBuilder(object):
     """Parse the input file and build a graph out of it (save its contents in memory)
 
         Arguments:
-            osm_path: Path of the .osm file to be used, located in the osm_dir given in settings.py. Not
+            osm_path: Path of the .osm or .osm.pbf file to be used, located in the osm_dir given in settings.py. Not
             necessary if existing_data is True
             log_callback: Parent Logger; If None, logs to a new file.
             """
 
-    latitude = 0
-    longitude = 1
-
     def __init__(self, osm_path, name: str = None, log_callback: Logger = None):
         self.name = name
         # initialize logging
@@ -31,17 +99,15 @@ class GraphBuilder(object):
         # initialize street network
         self.street_network = StreetNetwork()
 
-        # coord pairs as returned
-        self.coords = dict()
+        # coordinates of all nodes, stored at the position given by self._node_index[osm_id]
+        self._node_index = dict()
+        self.latitudes = np.empty(0)
+        self.longitudes = np.empty(0)
 
-        # max and min latitude and longitude
+        # max and min latitude and longitude, set by parse if there are any nodes
         self.bounds = dict()
-        self.bounds["min_lat"] = 9999
-        self.bounds["max_lat"] = -9999
-        self.bounds["min_lon"] = 9999
-        self.bounds["max_lon"] = -9999
 
-        # active copy of OSM data indexed by osm_id
+        # active copy of OSM data indexed by osm_id; untagged nodes only appear in self._node_index
         self.all_osm_relations = dict()
         self.all_osm_ways = dict()
         self.all_osm_nodes = dict()
@@ -51,6 +117,9 @@ class GraphBuilder(object):
         self.industrial_nodes = set()
         self.commercial_nodes = set()
 
+        # memoized results of get_all_child_nodes
+        self._children_cache = dict()
+
         # subset that is also connected to the street network
         self.connected_residential_nodes = set()
         self.connected_industrial_nodes = set()
@@ -89,116 +158,106 @@ class GraphBuilder(object):
         self.logger.info("Parsing .osm data")
         self.parse(osm_path)
 
-        self.logger.info("Building Street Network")
-        self.build_street_network()
+        # both only read the parsed data and write to disjoint attributes, so they can run concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.logger.info("Building Street Network")
+            street_network_built = executor.submit(self.build_street_network)
+            self.logger.info("Finding node categories")
+            node_categories_found = executor.submit(self.find_node_categories)
+            street_network_built.result()
+            node_categories_found.result()
 
-        self.logger.info("Finding node categories")
-        self.find_node_categories()
+        self.logger.info("Finding node categories connected to the street network")
+        self.find_connected_nodes()
 
     def build_street_network(self):
         self.logger.debug("Adding boundaries to street network")
-        if 9999 not in self.bounds.values() and -9999 not in self.bounds.values():
+        if self.bounds:
             self.street_network.set_bounds(self.bounds["min_lat"], self.bounds["max_lat"],
                                            self.bounds["min_lon"], self.bounds["max_lon"])
 
+        highways = [way for way in self.all_osm_ways.values() if "highway" in way.tags and way.nodes]
+
+        # calculate the lengths of all street segments at once, in the order they are visited below
+        segment_starts = [way.nodes[i] for way in highways for i in range(0, len(way.nodes) - 1)]
+        segment_ends = [way.nodes[i + 1] for way in highways for i in range(0, len(way.nodes) - 1)]
+        lengths = iter(self.lengths_haversine(segment_starts, segment_ends).tolist())
+
         # construct the actual graph structure from the input data
-        for way in self.all_osm_ways.values():
-            if "highway" in way.tags:
-                if not way.nodes:
-                    continue
-                if not self.street_network.has_node(way.nodes[0]):
-                    coord = self.coords[way.nodes[0]]
-                    self.street_network.add_node(way.nodes[0], coord[self.longitude], coord[self.latitude])
-                for i in range(0, len(way.nodes) - 1):
-                    if not self.street_network.has_node(way.nodes[i + 1]):
-                        coord = self.coords[way.nodes[i + 1]]
-                        self.street_network.add_node(way.nodes[i + 1], coord[self.longitude], coord[self.latitude])
-                    oneway = False
-                    if "oneway" in way.tags:
-                        if "oneway" == "Yes":
-                            oneway = True
-
-                    # calculate street length
-
-                    length = self.length_haversine(way.nodes[i], way.nodes[i + 1])
-
-                    # determine max speed
-                    max_speed = 50
-                    if way.tags["highway"] in self.max_speed_map.keys():
-                        max_speed = self.max_speed_map[way.tags["highway"]]
-                    if "maxspeed" in way.tags:
-                        max_speed_tag = way.tags["maxspeed"]
-                        if max_speed_tag.isdigit():
-                            max_speed = int(max_speed_tag)
-                        elif max_speed_tag.endswith("mph"):
-                            max_speed = int(max_speed_tag.replace("mph", "").strip(" "))
-                        elif max_speed_tag == "none":
-                            max_speed = 140
-
-                    # determine number of lanes
-                    number_of_lanes = 1
-                    if "lanes" in way.tags:
-                        number_of_lanes = int(way.tags['lanes'])
-                    else:
-                        if way.tags['highway'] in self.lane_map.keys():
-                            number_of_lanes = self.lane_map[way.tags['highway']]
-                    if not oneway:
-                        if "lanes:forward" in way.tags and "lanes:backward" in way.tags:
-                            number_of_lanes_forward = int(way.tags['lanes:forward'])
-
-                            number_of_lanes_backward = int(way.tags['lanes:backward'])
-                        else:
-                            number_of_lanes_forward = float(number_of_lanes) / 2
-                            number_of_lanes_backward = float(number_of_lanes) / 2
-                    # add street to street network
-                    if oneway:
-                        street = (way.nodes[i], way.nodes[i + 1])
-                        if not self.street_network.has_street(street):
-                            self.street_network.add_street(street, length, max_speed, number_of_lanes)
-                    else:
-                        forward_street = (way.nodes[i], way.nodes[i + 1])
-                        if not self.street_network.has_street(forward_street):
-                            # noinspection PyUnboundLocalVariable
-                            self.street_network.add_street(forward_street, length, max_speed, number_of_lanes_forward)
-                        backward_street = (way.nodes[i + 1], way.nodes[i])
-                        if not self.street_network.has_street(backward_street):
-                            # noinspection PyUnboundLocalVariable
-                            self.street_network.add_street(backward_street, length, max_speed, number_of_lanes_backward)
+        for way in highways:
+            nodes = way.nodes
+            # tags are the same for all segments of a way, so only evaluate them once per way
+            oneway = way.tags.get("oneway") in ("yes", "true", "1")
+            max_speed = self._resolve_max_speed(way.tags)
+            number_of_lanes_forward, number_of_lanes_backward = self._resolve_lanes(way.tags, oneway)
+
+            if not self.street_network.has_node(nodes[0]):
+                index = self._node_index[nodes[0]]
+                self.street_network.add_node(nodes[0], self.longitudes[index], self.latitudes[index])
+            for i in range(0, len(nodes) - 1):
+                if not self.street_network.has_node(nodes[i + 1]):
+                    index = self._node_index[nodes[i + 1]]
+                    self.street_network.add_node(nodes[i + 1], self.longitudes[index], self.latitudes[index])
+
+                length = next(lengths)
+
+                # add street to street network
+                forward_street = (nodes[i], nodes[i + 1])
+                if not self.street_network.has_street(forward_street):
+                    self.street_network.add_street(forward_street, length, max_speed, number_of_lanes_forward)
+                if not oneway:
+                    backward_street = (nodes[i + 1], nodes[i])
+                    if not self.street_network.has_street(backward_street):
+                        self.street_network.add_street(backward_street, length, max_speed, number_of_lanes_backward)
 
         return self.street_network
 
+    def _resolve_max_speed(self, tags):
+        """Determine the max speed of a way from its tags"""
+        max_speed = self.max_speed_map.get(tags["highway"], 50)
+        max_speed_tag = tags.get("maxspeed")
+        if max_speed_tag is not None:
+            max_speed = parse_max_speed(max_speed_tag, max_speed)
+        return max_speed
+
+    def _resolve_lanes(self, tags, oneway):
+        """Determine the number of lanes of a way from its tags
+
+        Returns:
+            (number of forward lanes, number of backward lanes), the latter being None for oneway streets
+        """
+        lanes_tag = tags.get("lanes")
+        number_of_lanes = int(lanes_tag) if lanes_tag is not None else self.lane_map.get(tags["highway"], 1)
+        if oneway:
+            return number_of_lanes, None
+        lanes_forward_tag = tags.get("lanes:forward")
+        lanes_backward_tag = tags.get("lanes:backward")
+        if lanes_forward_tag is not None and lanes_backward_tag is not None:
+            return int(lanes_forward_tag), int(lanes_backward_tag)
+        return float(number_of_lanes) / 2, float(number_of_lanes) / 2
+
     def find_node_categories(self):
         """Collect relevant categories of nodes in their respective sets"""
-        # TODO there has to be a better way to do this
         # TODO do this inside class StreetNetwork?
-        for relation in self.all_osm_relations.values():
-            if "landuse" in relation.tags:
-                if relation.tags["landuse"] == "residential":
-                    self.residential_nodes = self.residential_nodes | self.get_all_child_nodes(relation.id)
-                if relation.tags["landuse"] == "industrial":
-                    self.industrial_nodes = self.industrial_nodes | self.get_all_child_nodes(relation.id)
-                if relation.tags["landuse"] == "commercial":
-                    self.commercial_nodes = self.commercial_nodes | self.get_all_child_nodes(relation.id)
-        for way in self.all_osm_ways.values():
-            if "landuse" in way.tags:
-                if way.tags["landuse"] == "residential":
-                    self.residential_nodes = self.residential_nodes | self.get_all_child_nodes(way.id)
-                if way.tags["landuse"] == "industrial":
-                    self.industrial_nodes = self.industrial_nodes | self.get_all_child_nodes(way.id)
-                if way.tags["landuse"] == "commercial":
-                    self.commercial_nodes = self.commercial_nodes | self.get_all_child_nodes(way.id)
-        for node in self.all_osm_nodes.values():
-            if "landuse" in node.tags:
-                if node.tags["landuse"] == "residential":
-                    self.residential_nodes = self.residential_nodes | self.get_all_child_nodes(node.id)
-                if node.tags["landuse"] == "industrial":
-                    self.industrial_nodes = self.industrial_nodes | self.get_all_child_nodes(node.id)
-                if node.tags["landuse"] == "commercial":
-                    self.commercial_nodes = self.commercial_nodes | self.get_all_child_nodes(node.id)
-        street_network_nodes = set(self.street_network.get_nodes())
-        self.connected_residential_nodes = self.residential_nodes & street_network_nodes
-        self.connected_industrial_nodes = self.industrial_nodes & street_network_nodes
-        self.connected_commercial_nodes = self.commercial_nodes & street_network_nodes
+        landuse_nodes = {
+            "residential": self.residential_nodes,
+            "industrial" : self.industrial_nodes,
+            "commercial" : self.commercial_nodes,
+        }
+        for entities in (self.all_osm_relations, self.all_osm_ways, self.all_osm_nodes):
+            for entity in entities.values():
+                nodes = landuse_nodes.get(entity.tags.get("landuse"))
+                if nodes is not None:
+                    nodes.update(self.get_all_child_nodes(entity.id))
+
+    def find_connected_nodes(self):
+        """Collect the nodes of each category that are part of the street network. Requires both
+        build_street_network and find_node_categories to be finished."""
+        # the landuse sets are smaller than the street network, so they are iterated and the street network is probed
+        has_node = self.street_network.has_node
+        self.connected_residential_nodes = set(filter(has_node, self.residential_nodes))
+        self.connected_industrial_nodes = set(filter(has_node, self.industrial_nodes))
+        self.connected_commercial_nodes = set(filter(has_node, self.commercial_nodes))
 
         if not self.connected_residential_nodes:
             self.logger.warn("Residential Nodes are empty")
@@ -209,65 +268,77 @@ class GraphBuilder(object):
             self.logger.warn("Commercial Nodes are empty")
 
     def parse(self, osm_file):
-        for entity in osmread.parse_file(osm_file):
-            if isinstance(entity, osmread.Node):
-                self.all_osm_nodes[entity.id] = entity
-                coord = Coordinate(latitude=entity.lat, longitude=entity.lon)
-                self.adjust_borders(coord)
-                self.coords[entity.id] = coord
-            elif isinstance(entity, osmread.Way):
-                self.all_osm_ways[entity.id] = entity
-            elif isinstance(entity, osmread.Relation):
-                self.all_osm_relations[entity.id] = entity
-
-    def adjust_borders(self, coord):
-        lon, lat = coord
-        self.bounds["min_lat"] = min(self.bounds["min_lat"], lat)
-        self.bounds["min_lon"] = min(self.bounds["min_lon"], lon)
-        self.bounds["max_lat"] = max(self.bounds["max_lat"], lat)
-        self.bounds["max_lon"] = max(self.bounds["max_lon"], lon)
+        """Read a .osm or .osm.pbf file, the format is determined by the file extension"""
+        handler = _OSMHandler(self)
+        handler.apply_file(osm_file, locations=False)
+
+        self.latitudes = np.frombuffer(handler.latitudes, dtype=np.float64)
+        self.longitudes = np.frombuffer(handler.longitudes, dtype=np.float64)
+        if self.latitudes.size:
+            self.bounds["min_lat"] = float(self.latitudes.min())
+            self.bounds["max_lat"] = float(self.latitudes.max())
+            self.bounds["min_lon"] = float(self.longitudes.min())
+            self.bounds["max_lon"] = float(self.longitudes.max())
 
     def get_all_child_nodes(self, osm_id):
-        """given any OSM osm_id, construct a set of the ids of all descendant nodes"""
-        if osm_id in self.all_osm_nodes.keys():
-            return {osm_id}
-        if osm_id in self.all_osm_relations.keys():
-            children = set()
-            for child in self.all_osm_relations[osm_id].members:
-                children = children | self.get_all_child_nodes(child.member_id)
-            return children
-        if osm_id in self.all_osm_ways.keys():
-            children = set()
-            for ref in self.all_osm_ways[osm_id].nodes:
-                children.add(ref)
-            return children
-        return set()  # TODO deal properly with members not on map
+        """given any OSM osm_id, construct a set of the ids of all descendant nodes
+
+        Results are memoized, so the returned set must not be modified."""
+        if osm_id in self._children_cache:
+            return self._children_cache[osm_id]
+        node_index, ways, relations = self._node_index, self.all_osm_ways, self.all_osm_relations
+        children = set()
+        visited_relations = set()  # relations may (indirectly) contain themselves
+        stack = [osm_id]
+        while stack:
+            current = stack.pop()
+            if current in self._children_cache:
+                children.update(self._children_cache[current])
+            elif current in node_index:
+                children.add(current)
+            elif current in relations:
+                if current not in visited_relations:
+                    visited_relations.add(current)
+                    stack.extend(member.member_id for member in relations[current].members)
+            elif current in ways:
+                # ways only consist of nodes, no need to descend any further
+                children.update(ways[current].nodes)
+            # TODO deal properly with members not on map
+        self._children_cache[osm_id] = children
+        return children
+
+    def lengths_haversine(self, ids1, ids2):
+        """Vectorized version of length_haversine, calculating the distances between all pairs of nodes in ids1 and
+        ids2 at once"""
+        indices1 = np.fromiter((self._node_index[osm_id] for osm_id in ids1), dtype=np.int64, count=len(ids1))
+        indices2 = np.fromiter((self._node_index[osm_id] for osm_id in ids2), dtype=np.int64, count=len(ids2))
+        lat1 = np.radians(self.latitudes[indices1])
+        lat2 = np.radians(self.latitudes[indices2])
+        delta_lon = np.radians(self.longitudes[indices2] - self.longitudes[indices1])
+        delta_lat = lat2 - lat1
+        a = np.sin(delta_lat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(delta_lon / 2) ** 2
+        c = 2 * np.arcsin(np.sqrt(a))
+        return 6367000 * c  # return distances in m
 
     def length_euclidean(self, id1, id2):
         # calculate distance on a 2D plane assuming latitude and longitude
         # form a planar uniform coordinate system (obviously not 100% accurate)
-        p1 = self.coords[id1]
-        p2 = self.coords[id2]
-        # assuming distance between to degrees of latitude to be approx.
+        index1 = self._node_index[id1]
+        index2 = self._node_index[id2]
+        # assuming distance between two degrees of longitude to be approx.
         # 66.4km as is the case for Hamburg, and distance between two
-        # degrees of longitude is always 111.32km
-        dist = sqrt(((p2[self.latitude] - p1[self.latitude]) * 111.32) ** 2
-                    + ((p2[self.longitude] - p1[self.longitude]) * 66.4) ** 2)
+        # degrees of latitude is always 111.32km
+        dist = sqrt(((self.latitudes[index2] - self.latitudes[index1]) * 111.32) ** 2
+                    + ((self.longitudes[index2] - self.longitudes[index1]) * 66.4) ** 2)
         return dist * 1000  # return distance in m
 
     def length_haversine(self, id1, id2):
         """Calculate distance using the haversine formula, which incorporates earth curvature. See
         http://en.wikipedia.org/wiki/Haversine_formula"""
-        lat1 = self.coords[id1][self.latitude]
-        lon1 = self.coords[id1][self.longitude]
-        lat2 = self.coords[id2][self.latitude]
-        lon2 = self.coords[id2][self.longitude]
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-        delta_lon = lon2 - lon1
-        delta_lat = lat2 - lat1
-        a = sin(delta_lat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(delta_lon / 2) ** 2
-        c = 2 * asin(sqrt(a))
-        return 6367000 * c  # return distance in m
+        index1 = self._node_index[id1]
+        index2 = self._node_index[id2]
+        return haversine(self.latitudes[index1], self.longitudes[index1],
+                         self.latitudes[index2], self.longitudes[index2])
 
 
 if __name__ == "__main__":
@@ -285,11 +356,12 @@ if __name__ == "__main__":
     initialized = time()
 
     builder.find_node_categories()
+    builder.find_connected_nodes()
 
     categorized = time()
 
     # noinspection PyProtectedMember
-    paths, distances = builder.street_network.calculate_shortest_paths(1287690225)
+    predecessors = builder.street_network.calculate_shortest_paths(1287690225)
 
     pathed = time()
 
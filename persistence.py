@@ -1,46 +1,145 @@
-import array
+import atexit
+import io
 import os
 import pickle
+import queue
+import threading
 import zlib
 
+import numpy as np
+import zstandard
+
 from settings import settings
 
+# magic number at the start of every zstandard frame, used to tell compressed files apart from legacy zlib ones
+ZSTD_MAGIC_NUMBER = b"\x28\xb5\x2f\xfd"
+
+_compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+_decompressor = zstandard.ZstdDecompressor()
+
+# (path, bytes, compress) tuples to be written by the background writer thread, see persist_write
+_write_queue = queue.Queue(maxsize=4)
+_writer_thread = None
+_write_errors = []
+# directories _write_file already made sure exist
+_existing_directories = set()
+
 
 def persist_serialize(data, compress=True):
     """This function serializes and compresses an object"""
     if compress:
-        return zlib.compress(pickle.dumps(data))
+        return _compressor.compress(pickle.dumps(data, protocol=5))
     else:
-        return pickle.dumps(data)
+        return pickle.dumps(data, protocol=5)
 
 
 def persist_deserialize(data, compressed=True):
     """This function deserializes and decompresses an object"""
     if compressed:
+        if data.startswith(ZSTD_MAGIC_NUMBER):
+            # streamed frames don't record their content size, which decompress needs
+            return pickle.load(_decompressor.stream_reader(io.BytesIO(data)))
+        # files written before the switch to zstandard
         return pickle.loads(zlib.decompress(data))
     else:
         return pickle.loads(data)
 
 
-def persist_write(filename, data, compress=True, is_array=False, directory=settings['persistent_files_dir']):
-    """This function saves a data structure to a file"""
-    filename = directory + filename
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "wb") as f:
+def persist_dump(data, f, compress=True):
+    """This function serializes and compresses an object directly into a file object"""
+    if compress:
+        with _compressor.stream_writer(f, closefd=False) as compressed:
+            pickle.dump(data, compressed, protocol=5)
+    else:
+        pickle.dump(data, f, protocol=5)
+
+
+def persist_load(f, compressed=True):
+    """This function reads, decompresses and deserializes an object from a file object"""
+    if compressed:
+        magic_number = f.read(len(ZSTD_MAGIC_NUMBER))
+        f.seek(0)
+        if magic_number == ZSTD_MAGIC_NUMBER:
+            return pickle.load(_decompressor.stream_reader(f, closefd=False))
+        # files written before the switch to zstandard
+        return pickle.loads(zlib.decompress(f.read()))
+    else:
+        return pickle.load(f)
+
+
+def _write_file(path, write):
+    directory = os.path.dirname(path)
+    if directory not in _existing_directories:
+        os.makedirs(directory, exist_ok=True)
+        _existing_directories.add(directory)
+    with open(path, "wb") as f:
+        write(f)
+
+
+def _background_writer():
+    # a compressor must not be used by two threads at once, so this thread doesn't share _compressor
+    compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+
+    def write_compressed(f, data):
+        with compressor.stream_writer(f, closefd=False) as compressed:
+            compressed.write(data)
+
+    while True:
+        path, data, compress = _write_queue.get()
+        try:
+            if compress:
+                # zstandard releases the GIL, so compressing here doesn't hold up the thread that queued the data.
+                # The data is compressed straight into the file, without a compressed copy of it in memory
+                _write_file(path, lambda f: write_compressed(f, data))
+            else:
+                _write_file(path, lambda f: f.write(data))
+        except Exception as error:
+            _write_errors.append(error)
+        finally:
+            _write_queue.task_done()
+
+
+def persist_write(filename, data, compress=True, is_array=False, directory=settings['persistent_files_dir'],
+                  background=False):
+    """This function saves a data structure to a file
+
+    If background is True, a snapshot of data is taken and written to disk by a separate thread, so data may be
+    modified right after this function returns. Use persist_flush to wait until all files are written.
+    """
+    global _writer_thread
+    path = directory + filename
+    if background:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_background_writer, name="persist_write", daemon=True)
+            _writer_thread.start()
+            atexit.register(persist_flush)
         if is_array:
-            data.tofile(f)
+            _write_queue.put((path, bytes(memoryview(data)), False))
+        else:
+            _write_queue.put((path, persist_serialize(data, compress=False), compress))
+    elif is_array:
+        if isinstance(data, np.ndarray):
+            _write_file(path, data.tofile)
         else:
-            f.write(persist_serialize(data, compress))
+            _write_file(path, lambda f: f.write(memoryview(data).cast("B")))
+    else:
+        _write_file(path, lambda f: persist_dump(data, f, compress))
+
+
+def persist_flush():
+    """Wait until all files passed to persist_write with background=True are written"""
+    _write_queue.join()
+    if _write_errors:
+        error = _write_errors[0]
+        _write_errors.clear()
+        raise error
 
 
 def persist_read(filename, compressed=True, is_array=False, directory=settings['persistent_files_dir']):
     """This function reads a data structure from a file"""
     filename = directory + filename
-    with open(filename, "rb") as f:
-        data = f.read()
     if is_array:
-        result = array.array("I")
-        result.frombytes(data)
-    else:
-        result = persist_deserialize(data, compressed)
-    return result
+        # read straight into an array of unsigned 32-bit ints, no intermediate bytes object
+        return np.fromfile(filename, dtype=np.uint32)
+    with open(filename, "rb") as f:
+        return persist_load(f, compressed)
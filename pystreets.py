@@ -3,7 +3,7 @@ from random import random, seed
 
 import logger
 from osm_data import GraphBuilder
-from persistence import persist_write, persist_read
+from persistence import persist_flush, persist_write, persist_read
 from settings import settings
 from simulation import Simulation
 from trip_generator import generate_trips
@@ -15,7 +15,7 @@ class PyStreets(object):
 
     Attributes:
         name: Determines renders_dir and is used for logging
-        osm_filename: Filename of the .osm file to be used, which should be located in the osm_dir given in
+        osm_filename: Filename of the .osm or .osm.pbf file to be used, which should be located in the osm_dir given in
         settings.py. Not necessary if existing_data is True
         existing_data: Path of an existing data.pystreets file to be used instead of data newly extracted from a .osm
         file. If not None, significantly reduces startup time.
@@ -59,11 +59,12 @@ class PyStreets(object):
             self.logger.info("Getting street network")
             self.street_network = self.data.street_network
 
+            # both are compressed and written by a background thread while the simulation gets going
             self.logger.info("Saving OpenStreetMap data to disk")
-            self.persist_write(filename=f"data.pystreets", data=self.data)
+            self.persist_write(filename=f"data.pystreets", data=self.data, background=True)
 
             self.logger.info("Saving street network to disk")
-            self.persist_write(f"street_network.pystreets", self.street_network)
+            self.persist_write(f"street_network.pystreets", self.street_network, background=True)
         else:
             self.logger.info("Reading existing OpenStreetMap data from disk")
             self.data = self.persist_read(existing_data)
@@ -93,7 +94,8 @@ class PyStreets(object):
         else:
             potential_origins = self.street_network.get_nodes()
             potential_goals = self.street_network.get_nodes()
-        trips = generate_trips(number_of_residents, potential_origins, potential_goals)
+        trips = generate_trips(number_of_residents, potential_origins, potential_goals, settings["random_seed"])
+        self.logger.info("Generated trips for %d residents from %d distinct origins", number_of_residents, len(trips))
 
         # set traffic jam tolerance for this process and its test_trips
         if settings['jam_tolerance'] is None:
@@ -112,12 +114,20 @@ class PyStreets(object):
                 self.logger.info("Road construction taking place")
                 simulation.road_construction()
 
-            self.logger.info(f"Running simulation step {step + 1} of {settings['max_simulation_steps']} ")
+            self.logger.info("Running simulation step %d of %d", step + 1, settings['max_simulation_steps'])
             simulation.step()
-            self.logger.info("Saving traffic load to disk")
-            self.persist_write(f"traffic_load_{step + 1}.pystreets", simulation.traffic_load, is_array=True)
+            if settings["persist_traffic_load"]:
+                self.logger.info("Saving traffic load to disk")
+                self.persist_write(f"traffic_load_{step + 1}.pystreets", simulation.traffic_load, is_array=True,
+                                   background=True)
+        simulation.close()
+        self.logger.info("Waiting for traffic load to be written to disk")
+        persist_flush()
         self.logger.info("Simulation complete")
-        if visualize:
+        if visualize and not settings["persist_traffic_load"]:
+            # any traffic load files on disk are from an earlier run and must not be drawn as this one
+            self.logger.warning("Traffic load of this simulation was not saved to disk and can't be visualized")
+        elif visualize:
             self.logger.info("Starting visualization")
             self.visualization.visualize()
             self.logger.info("Visualization complete")
@@ -128,7 +138,7 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--osm_filename", "-f", help='''Filename of the .osm file to be used, which should be located in the 
+    parser.add_argument("--osm_filename", "-f", help='''Filename of the .osm or .osm.pbf file to be used, which should be located in the 
     osm_dir given in settings.py. Not necessary if existing_data is True''', default="test.osm")
     parser.add_argument("--name", "-n", help='''Determines directory for renders and is used for logging''',
                         default="test")
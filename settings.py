@@ -4,6 +4,8 @@ settings = {
     "persistent_files_dir"             : "./persistent files/",
     "osm_dir"                          : "./osm/",
     "random_seed"                      : None,  # set to None to use system time
+    # save the traffic load of every simulation step to disk, needed for visualization
+    "persist_traffic_load"             : True,
 
     # logging
     "logs_dir"                         : "./logs/",
@@ -23,9 +25,18 @@ settings = {
     # see http://www.bense-jessen.de/Infos/Page10430/page10430.html
     "braking_deceleration"             : 7.5,  # m/s²
     "steps_between_street_construction": 10,
+    # share of least used streets that get slower and of most used streets that get faster during road construction
+    "street_deconstruction_share"      : 0.15,
+    "street_construction_share"        : 0.05,
+    "street_construction_speed_delta"  : 10,  # km/h
     "trip_volume"                      : 1,
+    # shortest paths are calculated for batches of origins, distributed over several processes
+    "shortest_path_batch_size"         : 32,
+    "simulation_processes"             : None,  # set to None to use all cores, 1 to stay in the main process
 
     # visualization settings
     "zoom"                             : 1,
     "max_resolution"                   : (15000, 15000),
+    # images of different steps are drawn in parallel, each process needs memory for a whole image
+    "visualization_processes"          : None,  # set to None to use half of the cores, 1 to stay in the main process
 }
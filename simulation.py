@@ -1,6 +1,9 @@
-from array import array
-from itertools import repeat
-from math import sqrt
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
 
 import logger
 from settings import settings
@@ -10,6 +13,9 @@ from street_network import StreetNetwork
 class Simulation(object):
     """This class does the actual simulation steps"""
 
+    # number of recent steps whose traffic load is kept to be reused if their driving times come up again
+    TRAFFIC_LOAD_CACHE_SIZE = 4
+
     # noinspection PyShadowingNames
     def __init__(self, street_network, trips, jam_tolerance,
                  name="PyStreets", log_callback=None):
@@ -19,63 +25,224 @@ class Simulation(object):
         self.trips = trips
         self.jam_tolerance = jam_tolerance
         self.step_counter = 0
-        self.traffic_load = array("I", repeat(0, self.street_network.street_index))
+        self.traffic_load = np.zeros(self.street_network.street_index, dtype=np.uint32)
+        # trips in terms of node indices: origins, and for each origin its unique goals and the number of trips to each
+        # residents of the same origin with the same goal share their path, so every goal is only routed once
+        node_index = self.street_network.node_index
+        self._trip_origins = np.fromiter((node_index(origin) for origin in self.trips), dtype=np.int32,
+                                         count=len(self.trips))
+        self._trip_goals = list()
+        self._trip_goal_counts = list()
+        for origin_goals in self.trips.values():
+            goals, counts = np.unique(np.fromiter((node_index(goal) for goal in origin_goals), dtype=np.int32,
+                                                  count=len(origin_goals)), return_counts=True)
+            self._trip_goals.append(goals)
+            self._trip_goal_counts.append(counts)
 
         self.cumulative_traffic_load = None
+        # traffic load and number of reached goals of recent steps, by their driving times and trip volume
+        self._traffic_load_cache = dict()
+        # street attribute arrays and car properties the ideal speeds were calculated for
+        self._ideal_speed_street_attributes = None
+        self._ideal_speed_car_properties = None
+        # ideal speed of every street, by street index
+        self._ideal_speeds = None
+        # processes routing the trips, started by the first step with several batches, and the driving time matrix
+        # they were started with. They are kept for all steps, see close
+        self._router_pool = None
+        self._router_pool_matrix = None
 
     def step(self):
         self.step_counter += 1
         self.logger.info("Preparing edges...")
 
-        # update driving time based on traffic load
-        for street, street_index, length, max_speed, number_of_lanes in self.street_network:
-            street_traffic_load = self.traffic_load[street_index]
+        # update driving time based on traffic load, for all streets at once
+        street_attributes = self.street_network.street_attribute_arrays()
+        lengths, max_speeds, numbers_of_lanes = street_attributes
+        car_properties = dict(car_length=settings["car_length"],
+                              min_breaking_distance=settings["min_breaking_distance"],
+                              braking_deceleration=settings["braking_deceleration"])
+        # ideal speed is when the street is empty, so it only changes with the streets themselves, e.g. when their max
+        # speed changes (street_attribute_arrays returns new arrays then)
+        if (self._ideal_speed_street_attributes is not street_attributes or
+                self._ideal_speed_car_properties != car_properties):
+            self._ideal_speed_street_attributes = street_attributes
+            self._ideal_speed_car_properties = car_properties
+            self._ideal_speeds = calculate_driving_speed(lengths, max_speeds, 0, numbers_of_lanes, **car_properties)
+        ideal_speeds = self._ideal_speeds
+        # actual speed may be less then that
+        actual_speeds = calculate_driving_speed(lengths, max_speeds, self.traffic_load, numbers_of_lanes,
+                                                **car_properties)
+        # based on traffic jam tolerance the deceleration is weighted differently
+        perceived_speeds = actual_speeds + (ideal_speeds - actual_speeds) * self.jam_tolerance
 
-            # ideal speed is when the street is empty
-            ideal_speed = calculate_driving_speed(length, max_speed, 0, number_of_lanes)
-            # actual speed may be less then that
-            actual_speed = calculate_driving_speed(length, max_speed, street_traffic_load, number_of_lanes)
-            # based on traffic jam tolerance the deceleration is weighted differently
-            perceived_speed = actual_speed + (ideal_speed - actual_speed) * self.jam_tolerance
+        driving_times = lengths / perceived_speeds
+        self.street_network.set_driving_times(driving_times)
 
-            driving_time = length / perceived_speed
+        # the routes only depend on the driving times, so the simulation settling into a cycle can be detected
+        cache_key = (driving_times.tobytes(), settings["trip_volume"])
+        if cache_key in self._traffic_load_cache:
+            self.logger.info("Driving times are the same as in an earlier step, reusing its traffic load")
+            traffic_load, goal_nr = self._traffic_load_cache[cache_key]
+            self.traffic_load[:] = traffic_load
+            self.logger.info("Successfully processed %d origins and %d goals", len(self.trips), goal_nr)
+            return
 
-            self.street_network.set_driving_time(street, driving_time)
+        self.logger.info("Processing trips...")
+        # group trips into batches of origins
+        batch_size = settings["shortest_path_batch_size"]
+        batches = [(self._trip_origins[start:start + batch_size], self._trip_goals[start:start + batch_size],
+                    self._trip_goal_counts[start:start + batch_size])
+                   for start in range(0, len(self._trip_origins), batch_size)]
 
         self.logger.info("Resetting traffic load...")
-        self.traffic_load = array("I", repeat(0, self.street_network.street_index))
+        self.traffic_load.fill(0)
 
-        self.logger.info("Processing trips...")
+        driving_time_matrix = self.street_network.driving_time_matrix()
+        router_arguments = (driving_time_matrix, *self.street_network.street_index_table(),
+                            self.street_network.street_index)
+        # only the driving times change from step to step, so they are all that is sent along with each batch
+        tasks = [(driving_time_matrix.data, settings["trip_volume"], batch) for batch in batches]
         goal_nr = 0
-        for origin_nr, origin in enumerate(self.trips.keys()):
-            # calculate all shortest paths from resident to every other node
-            self.logger.spam(f"Origin nr {origin_nr}...")
-            paths = self.street_network.calculate_shortest_paths(origin)
-            # increase traffic load
-            for goal in self.trips[origin]:
-                # is the goal even reachable at all? if not, ignore for now
-                if goal in paths:
-                    # hop along the edges until we're there
-                    goal_nr += 1
-                    current = goal
-                    while current != origin:
-                        street = (min(current, paths[current]), max(current, paths[current]))
-                        current = paths[current]
-                        usage = settings["trip_volume"]
-                        street_index = self.street_network.get_street_index(street)
-                        self.traffic_load[street_index] += usage
-        self.logger.info(f"Successfully processed {len(self.trips)} origins and {goal_nr} goals")
-
-
-def calculate_driving_speed(street_length, max_speed, number_of_trips, number_of_lanes=1):
+        # starting processes and handing them the driving time matrix only pays off for several batches
+        number_of_processes = min(settings["simulation_processes"] or os.cpu_count() or 1, len(batches))
+        if number_of_processes <= 1:
+            _init_router(*router_arguments)
+            results = map(_route_trips, tasks)
+        else:
+            # the matrix is replaced when streets are added, then the processes need to be started with the new one
+            if self._router_pool is None or self._router_pool_matrix is not driving_time_matrix:
+                self.close()
+                # spawned instead of forked, forking would copy the state of the threads writing logs and files
+                self._router_pool = ProcessPoolExecutor(max_workers=number_of_processes,
+                                                        mp_context=multiprocessing.get_context("spawn"),
+                                                        initializer=_init_router, initargs=router_arguments)
+                self._router_pool_matrix = driving_time_matrix
+            results = self._router_pool.map(_route_trips, tasks)
+        for batch_nr, (batch_traffic_load, batch_goal_nr) in enumerate(results):
+            self.logger.spam("Batch nr %d of %d done", batch_nr + 1, len(batches))
+            self.traffic_load += batch_traffic_load
+            goal_nr += batch_goal_nr
+
+        if len(self._traffic_load_cache) >= Simulation.TRAFFIC_LOAD_CACHE_SIZE:
+            del self._traffic_load_cache[next(iter(self._traffic_load_cache))]
+        self._traffic_load_cache[cache_key] = (self.traffic_load.copy(), goal_nr)
+        self.logger.info("Successfully processed %d origins and %d goals", len(self.trips), goal_nr)
+
+    def close(self):
+        """Stop the processes routing the trips, if any were started. Further steps start new ones if needed"""
+        if self._router_pool is not None:
+            self._router_pool.shutdown()
+            self._router_pool = None
+            self._router_pool_matrix = None
+
+    def road_construction(self):
+        """Lower the max speed of the least used streets and raise it for the most used ones"""
+        number_of_streets = self.traffic_load.size
+        number_of_deconstructed_streets = int(number_of_streets * settings["street_deconstruction_share"])
+        number_of_constructed_streets = int(number_of_streets * settings["street_construction_share"])
+        speed_delta = settings["street_construction_speed_delta"]
+        change_max_speed = self.street_network.change_max_speed
+        get_street_by_index = self.street_network.get_street_by_index
+        # only the streets at both ends are needed, not a full sort of all streets by traffic load
+        if number_of_deconstructed_streets > 0:
+            least_used_streets = np.argpartition(self.traffic_load, number_of_deconstructed_streets - 1)
+            for street_index in least_used_streets[:number_of_deconstructed_streets].tolist():
+                change_max_speed(get_street_by_index(street_index), -speed_delta)
+        if number_of_constructed_streets > 0:
+            most_used_streets = np.argpartition(self.traffic_load, number_of_streets - number_of_constructed_streets)
+            for street_index in most_used_streets[number_of_streets - number_of_constructed_streets:].tolist():
+                change_max_speed(get_street_by_index(street_index), speed_delta)
+        self.logger.info("Slowed down %d streets and sped up %d streets", number_of_deconstructed_streets,
+                         number_of_constructed_streets)
+
+
+# state of the process routing trips, set by _init_router
+_router = dict()
+
+
+def _init_router(driving_time_matrix, street_keys, street_indices, number_of_streets):
+    _router["driving_time_matrix"] = driving_time_matrix
+    _router["street_keys"] = street_keys
+    _router["street_indices"] = street_indices
+    _router["number_of_streets"] = number_of_streets
+
+
+def _route_trips(task):
+    """Send the trips of a batch of origins along their shortest paths
+
+    Args:
+        task: (data of the driving time matrix of the current step, trip volume, batch) with batch being (array of
+            origin node indices, array of unique goal node indices for each origin, array of the number of trips to
+            each of those goals for each origin)
+
+    Returns:
+        (traffic load caused by the trips, number of goals that could be reached)
+    """
+    driving_times, trip_volume, (origins, goals, goal_counts) = task
+    driving_time_matrix = _router["driving_time_matrix"]
+    driving_time_matrix.data = driving_times
+    # calculate all shortest paths from the origins to every other node at once
+    all_predecessors = dijkstra(driving_time_matrix, indices=origins, return_predecessors=True)[1]
+
+    # one entry per distinct trip: row of its origin in all_predecessors, its origin, the node it currently is at and
+    # the number of residents taking it
+    rows = np.repeat(np.arange(len(origins)), [len(origin_goals) for origin_goals in goals])
+    trip_origins = origins[rows]
+    current = np.concatenate(goals)
+    trip_counts = np.concatenate(goal_counts)
+    # is the goal even reachable at all? if not, ignore for now
+    reachable = (current == trip_origins) | (all_predecessors[rows, current] >= 0)
+    goal_nr = int(trip_counts[reachable].sum())
+
+    # hop along the edges of all trips simultaneously until they are back at their origin
+    hop_origins = []
+    hop_targets = []
+    hop_counts = []
+    travelling = reachable & (current != trip_origins)
+    rows, trip_origins, current, trip_counts = (rows[travelling], trip_origins[travelling], current[travelling],
+                                                trip_counts[travelling])
+    while current.size:
+        previous = all_predecessors[rows, current]
+        hop_origins.append(previous)
+        hop_targets.append(current)
+        hop_counts.append(trip_counts)
+        travelling = previous != trip_origins
+        rows, trip_origins, current, trip_counts = (rows[travelling], trip_origins[travelling], previous[travelling],
+                                                    trip_counts[travelling])
+
+    if hop_origins:
+        # look up the streets the trips used by the node indices at both of their ends
+        hop_keys = (np.concatenate(hop_origins).astype(np.int64) * driving_time_matrix.shape[0] +
+                    np.concatenate(hop_targets))
+        streets = _router["street_indices"][np.searchsorted(_router["street_keys"], hop_keys)]
+        street_trips = np.concatenate(hop_counts)
+    else:
+        streets = np.empty(0, dtype=np.int64)
+        street_trips = np.empty(0, dtype=np.int64)
+    traffic_load = np.bincount(streets, weights=street_trips, minlength=_router["number_of_streets"]) * trip_volume
+    return traffic_load.astype(np.uint32), goal_nr
+
+
+def calculate_driving_speed(street_length, max_speed, number_of_trips, number_of_lanes=1, car_length=None,
+                            min_breaking_distance=None, braking_deceleration=None):
+    """Works on single streets as well as on arrays of streets
+
+    car_length, min_breaking_distance and braking_deceleration are read from the settings if not given.
+    """
+    if car_length is None:
+        car_length = settings["car_length"]
+    if min_breaking_distance is None:
+        min_breaking_distance = settings["min_breaking_distance"]
+    if braking_deceleration is None:
+        braking_deceleration = settings["braking_deceleration"]
     # distribute test_trips over the street
-    available_space_for_each_car = street_length * number_of_lanes / max(number_of_trips, number_of_lanes)  # m
-    available_braking_distance = max(available_space_for_each_car - settings["car_length"],
-                                     settings["min_breaking_distance"])  # m
+    available_space_for_each_car = street_length * number_of_lanes / np.maximum(number_of_trips, number_of_lanes)  # m
+    available_braking_distance = np.maximum(available_space_for_each_car - car_length, min_breaking_distance)  # m
     # how fast can a car drive to ensure the calculated breaking distance?
-    potential_speed = sqrt(settings["braking_deceleration"] * available_braking_distance * 2)  # m/s
+    potential_speed = np.sqrt(braking_deceleration * available_braking_distance * 2)  # m/s
     # cars respect speed limit
-    actual_speed = min(max_speed, potential_speed * 3.6)  # km/h
+    actual_speed = np.minimum(max_speed, potential_speed * 3.6)  # km/h
 
     return actual_speed
 
@@ -1,52 +1,81 @@
+from array import array
 from collections import namedtuple
 
-from pygraph.algorithms.minmax import shortest_path
-from pygraph.classes.digraph import digraph
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 
 
 class StreetNetwork(object):
     """This class represents a street_id network"""
 
-    STREET_ATTRIBUTE_INDEX = {
-        "index"          : 0,  # duplicate word "INDEX" on purpose
-        "length"         : 1,
-        "max_speed"      : 2,
-        "number_of_lanes": 3,
-    }
-    NODE_ATTRIBUTE_INDEX = {
-        "longitude": 0,
-        "latitude" : 1,
-    }
-
     def __init__(self):
-        # graph that holds the street network
-        self._graph = digraph()
         self.bounds = None
         # give every street a sequential index (used for performance optimization)
         self.street_index = 0
         self.streets_by_index = dict()
+        self._street_indices = dict()
+        # give every node a sequential index as well, used for the sparse matrix representation of the graph
+        self._node_index = dict()
+        self._nodes_by_index = list()
+        # coordinates of every node, by node index
+        self._node_longitudes = array("d")
+        self._node_latitudes = array("d")
+        # origin and target node index of every street, by street index
+        self._street_origins = array("q")
+        self._street_targets = array("q")
+        # attributes of every street, by street index
+        self._street_lengths = array("d")
+        self._street_max_speeds = array("d")
+        self._street_numbers_of_lanes = array("d")
+        self._driving_times = array("d")
+        # sparse matrix of driving times used for shortest path calculations, built by driving_time_matrix
+        self._driving_time_matrix_cache = None
+        # position of every street's driving time in self._driving_time_matrix_cache.data, by street index
+        self._driving_time_positions = None
+        # NumPy copies of the street attribute arrays, built by street_attribute_arrays
+        self._street_attribute_arrays_cache = None
+        # lookup table from pairs of node indices to street indices, built by street_index_table
+        self._street_index_table_cache = None
 
     def has_street(self, street):
-        return self._graph.has_edge(street)
+        return street in self._street_indices
 
     def add_street(self, street, length, max_speed, number_of_lanes=1):
-        # attribute order is given through constants ATTRIBUTE_INDEX_...
-        street_attributes = [self.street_index, length, max_speed, number_of_lanes]
         # set initial weight to ideal driving time
         driving_time = length / max_speed
-        self._graph.add_edge(street, wt=driving_time, attrs=street_attributes)
         self.streets_by_index[self.street_index] = street
+        self._street_indices[street] = self.street_index
+        self._street_origins.append(self._node_index[street[0]])
+        self._street_targets.append(self._node_index[street[1]])
+        self._street_lengths.append(length)
+        self._street_max_speeds.append(max_speed)
+        self._street_numbers_of_lanes.append(number_of_lanes)
+        self._driving_times.append(driving_time)
+        self._driving_time_matrix_cache = None
+        self._street_index_table_cache = None
+        self._street_attribute_arrays_cache = None
 
         self.street_index += 1
 
     def set_driving_time(self, street, driving_time):
-        self._graph.set_edge_weight(street, driving_time)
+        street_index = self.get_street_index(street)
+        self._driving_times[street_index] = driving_time
+        if self._driving_time_matrix_cache is not None:
+            self._driving_time_matrix_cache.data[self._driving_time_positions[street_index]] = driving_time
+
+    def set_driving_times(self, driving_times):
+        """Set the driving times of all streets at once, driving_times being an array indexed by street index"""
+        driving_times = np.asarray(driving_times, dtype=np.float64)
+        self._driving_times = array("d", driving_times.tobytes())
+        if self._driving_time_matrix_cache is not None:
+            self._driving_time_matrix_cache.data[self._driving_time_positions] = driving_times
 
     def get_driving_time(self, street):
-        return self._graph.edge_weight(street)
+        return self._driving_times[self.get_street_index(street)]
 
     def get_street_index(self, street):
-        return self._graph.edge_attributes(street)[StreetNetwork.STREET_ATTRIBUTE_INDEX['index']]
+        return self._street_indices[street]
 
     def get_street_by_index(self, street_index):
         if street_index in self.streets_by_index:
@@ -55,48 +84,112 @@ class StreetNetwork(object):
             return None
 
     def change_max_speed(self, street, max_speed_delta):
-        street_attributes = self._graph.edge_attributes(street)
-        current_max_speed = street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX['max_speed']]
-        street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX['max_speed']] = max(1, min(140,
-                                                                                          current_max_speed +
-                                                                                          max_speed_delta))
+        street_index = self._street_indices[street]
+        current_max_speed = self._street_max_speeds[street_index]
+        self._street_max_speeds[street_index] = max(1, min(140, current_max_speed + max_speed_delta))
+        self._street_attribute_arrays_cache = None
 
     def set_bounds(self, min_latitude, max_latitude, min_longitude, max_longitude):
         self.bounds = ((min_latitude, max_latitude), (min_longitude, max_longitude))
 
     def add_node(self, node, longitude, latitude):
-        # attribute order is given through constants ATTRIBUTE_INDEX_...
-        self._graph.add_node(node, [longitude, latitude])
+        self._node_index[node] = len(self._nodes_by_index)
+        self._nodes_by_index.append(node)
+        self._node_longitudes.append(longitude)
+        self._node_latitudes.append(latitude)
+        self._driving_time_matrix_cache = None
+        self._street_index_table_cache = None
 
     def get_nodes(self):
-        return self._graph.nodes()
+        return list(self._nodes_by_index)
 
     def get_edges(self):
-        return self._graph.edges()
+        return list(self.streets_by_index.values())
 
     def node_coordinates(self, node):
-        node_attributes = self._graph.node_attributes(node)
-
-        return (node_attributes[StreetNetwork.NODE_ATTRIBUTE_INDEX['longitude']],
-                node_attributes[StreetNetwork.NODE_ATTRIBUTE_INDEX['latitude']])
+        node_index = self._node_index[node]
+        return self._node_longitudes[node_index], self._node_latitudes[node_index]
 
     def has_node(self, node):
-        return self._graph.has_node(node)
+        return node in self._node_index
+
+    def node_index(self, node):
+        return self._node_index[node]
+
+    def node_by_index(self, node_index):
+        return self._nodes_by_index[node_index]
+
+    def driving_time_matrix(self):
+        """Sparse matrix with the driving time of the street from node i to node j at position (i, j)"""
+        if self._driving_time_matrix_cache is None:
+            number_of_nodes = len(self._nodes_by_index)
+            origins = np.array(self._street_origins, dtype=np.int64)
+            targets = np.array(self._street_targets, dtype=np.int64)
+            driving_times = np.array(self._driving_times, dtype=np.float64)
+            # CSR layout: streets sorted by origin node, rows delimited by the cumulative number of streets per node
+            order = np.lexsort((targets, origins))
+            row_pointers = np.zeros(number_of_nodes + 1, dtype=np.int64)
+            np.cumsum(np.bincount(origins, minlength=number_of_nodes), out=row_pointers[1:])
+            self._driving_time_matrix_cache = csr_matrix((driving_times[order], targets[order], row_pointers),
+                                                         shape=(number_of_nodes, number_of_nodes))
+            self._driving_time_positions = np.empty(self.street_index, dtype=np.int64)
+            self._driving_time_positions[order] = np.arange(self.street_index)
+        return self._driving_time_matrix_cache
+
+    def street_attribute_arrays(self):
+        """Lengths, max speeds and numbers of lanes of all streets as read-only arrays indexed by street index"""
+        if self._street_attribute_arrays_cache is None:
+            self._street_attribute_arrays_cache = tuple(np.array(attribute, dtype=np.float64) for attribute in
+                                                        (self._street_lengths, self._street_max_speeds,
+                                                         self._street_numbers_of_lanes))
+            for attribute in self._street_attribute_arrays_cache:
+                attribute.setflags(write=False)
+        return self._street_attribute_arrays_cache
+
+    def node_coordinate_arrays(self):
+        """Longitudes and latitudes of all nodes as two arrays indexed by node index"""
+        return np.array(self._node_longitudes, dtype=np.float64), np.array(self._node_latitudes, dtype=np.float64)
+
+    def street_node_indices(self):
+        """Node indices of the origin and the target of all streets as two arrays indexed by street index"""
+        return np.array(self._street_origins, dtype=np.int64), np.array(self._street_targets, dtype=np.int64)
+
+    def street_index_table(self):
+        """Lookup table from pairs of node indices to the index of the street between them
+
+        Returns:
+            A sorted array of keys origin node index * number of nodes + target node index, one for every street, and
+            an array holding the index of the street each key belongs to. Streets are found with np.searchsorted.
+        """
+        # the table only depends on which streets exist, so it is built once and reused by every simulation step
+        if self._street_index_table_cache is None:
+            origins, targets = self.street_node_indices()
+            keys = origins * len(self._nodes_by_index) + targets
+            order = np.argsort(keys)
+            keys = keys[order]
+            keys.setflags(write=False)
+            order.setflags(write=False)
+            self._street_index_table_cache = (keys, order)
+        return self._street_index_table_cache
 
     def calculate_shortest_paths(self, origin_node):
-        return shortest_path(self._graph, origin_node)[0]
+        """Calculate the shortest paths from origin_node to all other nodes
+
+        Returns:
+            An array containing the node index of the predecessor of each node index on its shortest path from
+            origin_node, or a negative value for origin_node itself and unreachable nodes.
+        """
+        return dijkstra(self.driving_time_matrix(), indices=self._node_index[origin_node],
+                        return_predecessors=True)[1]
 
     _Street_Attributes = namedtuple("Street_Attributes", ["street", "index", "length", "max_speed", "number_of_lanes"])
 
     def get_street_attributes(self, street):
-        street_attributes = self._graph.edge_attributes(street)
-        return (street, street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX['index']],
-                street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX['length']],
-                street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX['max_speed']],
-                street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX['number_of_lanes']])
+        street_index = self._street_indices[street]
+        return (street, street_index, self._street_lengths[street_index], self._street_max_speeds[street_index],
+                self._street_numbers_of_lanes[street_index])
 
     def __iter__(self):
-        """Iterate over the streets and their attributes"""
-        for street in self._graph.edges():
-            # get street attributes
-            yield self.get_street_attributes(street)
+        """Iterate over the streets and their attributes, ordered by street index"""
+        return zip(self.streets_by_index.values(), range(self.street_index), self._street_lengths,
+                   self._street_max_speeds, self._street_numbers_of_lanes)
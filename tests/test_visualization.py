@@ -0,0 +1,70 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import logger
+import visualization
+from settings import settings
+from street_network import StreetNetwork
+
+
+def square_street_network():
+    """Four nodes on the corners of a small square, connected by one street along each side"""
+    street_network = StreetNetwork()
+    street_network.set_bounds(53.0, 53.01, 10.0, 10.01)
+    corners = ((10.0, 53.0), (10.01, 53.0), (10.01, 53.01), (10.0, 53.01))
+    for node, (longitude, latitude) in enumerate(corners):
+        street_network.add_node(node, longitude, latitude)
+    for node in range(len(corners)):
+        street_network.add_street((node, (node + 1) % len(corners)), 1.0, 50)
+    return street_network
+
+
+class WorkerLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(settings)
+        self.directory = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
+        settings["logs_dir"] = f"{self.directory.name}/logs/"
+        settings["max_resolution"] = (200, 200)
+        os.makedirs(settings["logs_dir"])
+
+    def tearDown(self):
+        settings.clear()
+        settings.update(self.settings)
+        self.directory.cleanup()
+
+    def test_spawned_workers_log_to_the_log_file(self):
+        renderer = visualization.Visualization("worker logging", street_network=square_street_network(),
+                                               renders_dir=f"{self.directory.name}/renders/")
+        os.makedirs(renderer.renders_dir)
+        frames = [(1, 1, np.arange(4, dtype=np.uint32))]
+
+        # spawned workers get the Visualization by pickling, so its logger arrives without an ActionFilter
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=visualization._init_renderer,
+                                 initargs=(renderer, logger.log_queue())) as executor:
+            image_paths = list(executor.map(visualization._render_frame, frames))
+        self.assertTrue(os.path.isfile(image_paths[0]))
+
+        # the listener writes the records of the worker to the log file in the background
+        log_filename = logger._listener.handlers[0].baseFilename
+        deadline = time.monotonic() + 10
+        while True:
+            with open(log_filename) as log_file:
+                log = log_file.read()
+            if "Saving image to disk" in log or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertIn("- render - Drawing data of step nr 1", log)
+        self.assertIn("Finalizing Image", log)
+        self.assertIn("- save_image - Saving image to disk", log)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,30 +1,27 @@
-from random import sample
+import numpy as np
 
 
-def generate_trips(number_of_residents: int, potential_origins, potential_goals):
+def generate_trips(number_of_residents: int, potential_origins, potential_goals, random_seed=None):
     """
     Distribute the residents over the potential_origins and set random goals (out of the potential_goals) for them.
     Args:
         number_of_residents: number of residents to be distributed -> number of trips to be generated
         potential_origins: potential origin nodes
         potential_goals: potential goal nodes
+        random_seed: seed for the random number generator, None to use fresh entropy from the OS
 
     Returns:
         A dict with the potential_origins as keys and lists of destinations / goals as the values. The total number
         of all destinations should be equal to the number_of_residents.
     """
-    trips = dict()
-    number_of_goals = 0
-    for i in range(0, number_of_residents):
-        origin = sample(potential_origins, 1)[0]
-        goal = sample(potential_goals, 1)[0]
+    random_generator = np.random.default_rng(random_seed)
+    origins = random_generator.choice(np.fromiter(potential_origins, dtype=np.int64), number_of_residents)
+    goals = random_generator.choice(np.fromiter(potential_goals, dtype=np.int64), number_of_residents)
 
-        if origin in trips.keys():
-            goals = trips[origin]
-        else:
-            goals = list()
-        goals.append(goal)
-        number_of_goals += 1
-        trips[origin] = goals
-    assert number_of_goals == number_of_residents
+    # group the goals by their origin
+    order = np.argsort(origins, kind="stable")
+    unique_origins, first_positions = np.unique(origins[order], return_index=True)
+    goals_by_origin = np.split(goals[order], first_positions[1:])
+    trips = {origin: origin_goals.tolist() for origin, origin_goals in zip(unique_origins.tolist(), goals_by_origin)}
+    assert sum(len(goals) for goals in trips.values()) == number_of_residents
     return trips
@@ -1,9 +1,14 @@
+import colorsys
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from functools import partial
 from logging import Logger # for typing
+from math import ceil
 
-from PIL import Image, ImageChops, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 
 import logger
 from persistence import persist_read
@@ -31,6 +36,7 @@ class Visualization(object):
       renders_dir: Directory in which ".png"s are saved.
     """
     ATTRIBUTE_KEY_COMPONENT = 2
+    COLOR_TABLE_SIZE = 256  # number of distinct colors that values between 0 and 1 are mapped to, one per uint8
     coord2km = (111.32, 66.4)  # distances between 2 deg of lat/lon
 
     def __init__(self, name: str, mode: str = "Traffic_Load", color_mode="HEATMAP",
@@ -45,12 +51,12 @@ class Visualization(object):
         self.renders_dir = renders_dir if renders_dir is not None else f"{settings['renders_dir']}{self.name}/"
         self.persistent_files_dir = f"{settings['persistent_files_dir']}{self.name}/"
         self.persist_read = partial(persist_read, directory=self.persistent_files_dir)
-        self.traffic_load_filename_expression = re.compile("^traffic_load_[0-9]+.pystreets$")
+        self.traffic_load_filename_expression = re.compile(r"^traffic_load_([0-9]+)\.pystreets$")
 
         self.max_resolution = settings['max_resolution']
         self.zoom = settings['zoom']
 
-        self.node_coords = dict()
+        self.node_coords = None
 
         self.street_network = street_network
 
@@ -65,14 +71,40 @@ class Visualization(object):
         self.bounds = self.street_network.bounds
         self.zoom = self.max_resolution[0] / max((self.bounds[0][1] - self.bounds[0][0]) * self.coord2km[0],
                                                  (self.bounds[1][1] - self.bounds[1][0]) * self.coord2km[1])
-
-        self.node_coords = dict()
-        for node in self.street_network.get_nodes():
-            coords = self.street_network.node_coordinates(node)
-            point = dict()
-            for i in range(2):
-                point[i] = (coords[i] - self.bounds[i][0]) * self.coord2km[i] * self.zoom
-            self.node_coords[node] = (point[1], self.max_resolution[1] - point[0])  # x = longitude, y = latitude
+        # street attributes as arrays indexed by street index
+        self.lengths, self.max_speeds, self.numbers_of_lanes = self.street_network.street_attribute_arrays()
+        # the ideal speed is the speed on an empty street, it is the same for every step
+        self.ideal_speeds = calculate_driving_speed(self.lengths, self.max_speeds, 0)
+
+        # image coordinates of all nodes as (number of nodes, 2) array of x and y, by node index
+        longitudes, latitudes = self.street_network.node_coordinate_arrays()
+        x = (longitudes - self.bounds[1][0]) * self.coord2km[1] * self.zoom
+        y = self.max_resolution[1] - (latitudes - self.bounds[0][0]) * self.coord2km[0] * self.zoom
+        self.node_coords = np.stack((x, y), axis=1)
+
+        # two nodes are connected by at most two streets, one in each direction. For the street with the higher street
+        # index this is the index of the other one, otherwise -1
+        origins, targets = self.street_network.street_node_indices()
+        node_pairs = np.minimum(origins, targets) * len(self.node_coords) + np.maximum(origins, targets)
+        order = np.argsort(node_pairs, kind="stable")
+        same_node_pair = node_pairs[order[1:]] == node_pairs[order[:-1]]
+        self.opposite_streets = np.full(len(node_pairs), -1, dtype=np.int64)
+        self.opposite_streets[order[1:][same_node_pair]] = order[:-1][same_node_pair]
+
+        # image coordinates of the ends of all streets, by street index
+        self.street_starts = self.node_coords[origins]
+        self.street_ends = self.node_coords[targets]
+        # streets never leave the box spanned by their ends, so only the part of the image inside the bounding box of
+        # all street ends is drawn on: (left, upper, right, lower) like PIL boxes
+        if len(origins) > 0:
+            pixels = np.concatenate((self.street_starts, self.street_ends)).astype(np.int64)
+            left, upper = np.maximum(pixels.min(axis=0), 0).tolist()
+            right, lower = np.minimum(pixels.max(axis=0) + 1, self.max_resolution).tolist()
+            self.canvas_box = (left, upper, right, lower)
+        else:
+            self.canvas_box = (0, 0) + tuple(self.max_resolution)
+        # RGBA pixels of the canvas_box, allocated by the first draw and reused by all following ones
+        self._canvas = None
 
     @property
     def mode(self):
@@ -118,95 +150,184 @@ class Visualization(object):
             raise ValueError(f"Value must be one of {possible_color_modes}")
         self._color_mode = value
 
+        # RGBA color of each of the values i / (COLOR_TABLE_SIZE - 1), values in between are rounded up so only 0 itself
+        # gets the color of 0
+        self._color_table = np.empty((self.COLOR_TABLE_SIZE, 4), dtype=np.uint8)
+        for i in range(self.COLOR_TABLE_SIZE):
+            value = i / (self.COLOR_TABLE_SIZE - 1)
+            if self._color_mode == 'MONOCHROME':
+                brightness = min(255, int(15 + 240 * value))
+                self._color_table[i] = brightness, brightness, brightness, 0
+            if self._color_mode == 'HEATMAP':
+                limit = 0
+                if value <= limit:  # almost black to blue
+                    hue, lightness = 300, 8
+                else:  # blue to red
+                    hue, lightness = int(255 * (1 - (value - limit) / (1 - limit))), 30 + 20 * value
+                rgb = colorsys.hls_to_rgb(hue / 360, lightness / 100, 1.0)
+                self._color_table[i] = tuple(int(component * 255 + 0.5) for component in rgb) + (255,)
+
     def visualize(self):
         self.logger.info("Finding files")
         all_files = os.listdir(self.persistent_files_dir)
-        traffic_load_files = list(filter(self.traffic_load_filename_expression.search, all_files))
+        # numbers of the steps with traffic load files, in order
+        steps = sorted(int(match.group(1)) for match in map(self.traffic_load_filename_expression.search, all_files)
+                       if match is not None)
+        self.logger.debug("Found traffic data of steps %s", steps)
 
         self.logger.info("Reading street network")
         self.street_network = self.persist_read("street_network.pystreets")
 
         self.logger.debug("Finding maximum traffic load")
         max_load = 1
-        for traffic_load_file in traffic_load_files:
-            traffic_load = self.persist_read(traffic_load_file, is_array=True)
-            for street, street_index, length, max_speed, number_of_lanes in self.street_network:
-                max_load = max(max_load, traffic_load[street_index] / number_of_lanes)
+        # traffic loads are small compared to the images, so they are kept for drawing instead of being read again.
+        # Reading them in parallel keeps several reads in flight at once
+        with ThreadPoolExecutor() as executor:
+            traffic_loads = list(executor.map(partial(self.persist_read, is_array=True),
+                                              (f"traffic_load_{step}.pystreets" for step in steps)))
+        for traffic_load in traffic_loads:
+            max_load = max(max_load, np.max(traffic_load / self.numbers_of_lanes, initial=0))
         self.logger.debug(f"Maximum load is {max_load}")
 
-        self.logger.info("Starting to draw traffic loads")
-        step = 0
-        while len(traffic_load_files) > 0:
-            step += 1
-            self.logger.info(f"Doing step nr {step}")
-
-            # check if there is traffic load for the current step and draw it
-            traffic_load_filename = f"traffic_load_{step}.pystreets"
-            self.logger.debug(f"Traffic load filename is {traffic_load_filename}")
-            if traffic_load_filename in traffic_load_files:
-                self.logger.debug("Found traffic data")
+        frames = [(step, max_load, traffic_load) for step, traffic_load in zip(steps, traffic_loads)]
 
-                self.logger.info("Reading traffic load")
-                traffic_load = self.persist_read(traffic_load_filename, is_array=True)
+        self.logger.info("Starting to draw traffic loads")
+        os.makedirs(os.path.dirname(self.renders_dir), exist_ok=True)
+        # the frames are independent of each other, so they are drawn in several processes which each get a copy of
+        # this Visualization once. Each process needs memory for a whole image, so by default only half of the cores
+        # are used
+        number_of_processes = min(settings["visualization_processes"] or max(1, (os.cpu_count() or 1) // 2),
+                                  len(frames))
+        with ExitStack() as stack:
+            if number_of_processes <= 1:
+                # saving an image mostly waits for zlib, which releases the GIL, so the next image is drawn meanwhile
+                saver = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+                image_paths = self._render_while_saving(frames, saver)
+            else:
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=number_of_processes,
+                                                                   initializer=_init_renderer,
+                                                                   initargs=(self, logger.log_queue())))
+                image_paths = executor.map(_render_frame, frames)
+            for image_path in image_paths:
+                self.logger.info("Saved image %s", image_path)
 
-                self.logger.info("Drawing data")
-                street_network_image: Image = self.draw(max_load, traffic_load)
-                self.logger.info(f"Saving image to disk \
-                                 ({self.renders_dir}{self.mode.lower()}_{step}.png)")
-                os.makedirs(os.path.dirname(self.renders_dir), exist_ok=True)
-                street_network_image.save(f"{self.renders_dir}{self.mode.lower()}_{step}.png")
+        self.logger.info("Done!")
 
-                traffic_load_files.remove(traffic_load_filename)
+    def render(self, step: int, max_load: int, traffic_load: np.ndarray) -> str:
+        """
+        Draw the traffic load of a step and save the image to renders_dir
 
-        self.logger.info("Done!")
+        Args:
+          step: number of the simulation step, part of the image filename
+          max_load: highest traffic load per lane of all steps
+          traffic_load: traffic load of every street in this step, by street index
 
-    def draw(self, max_load: int, traffic_load: list) -> Image:
-        street_network_image = Image.new("RGBA", self.max_resolution, (0, 0, 0, 255))
-        draw = ImageDraw.Draw(street_network_image)
-        finished_streets = dict()
-        for street, street_index, length, max_speed, number_of_lanes in self.street_network:
-            width = 1  # max_speed / 50 looks bad for motorways
-            value = 0
-            current_traffic_load = traffic_load[street_index] / number_of_lanes
-            if self.mode == 'TRAFFIC_LOAD':
-                value = 1.0 * (current_traffic_load / max_load) ** (1 / 2)  # Sqrt for better visibility
-            if self.mode == 'MAX_SPEED':
-                value = min(1.0, 1.0 * max_speed / 140)
-            if self.mode == 'IDEAL_SPEED':
-                ideal_speed = calculate_driving_speed(length, max_speed, 0)
-                value = min(1.0, 1.0 * ideal_speed / 140)
-            if self.mode == 'ACTUAL_SPEED':
-                actual_speed = calculate_driving_speed(length, max_speed, current_traffic_load)
-                value = min(1.0, 1.0 * actual_speed / 140)
-            if self.mode == "NUMBER_OF_LANES":
-                value = min(1.0, number_of_lanes / 5)
-            if frozenset(street) in finished_streets.keys():
-                value += finished_streets[frozenset(street)]
-            color = self.value_to_color(value)
-            draw.line([self.node_coords[street[0]], self.node_coords[street[1]]], fill=color, width=width)
-            finished_streets[frozenset(street)] = value
+        Returns:
+            Path of the saved image
+        """
+        self.logger.info("Drawing data of step nr %d", step)
+        return self.save_image(self.draw(max_load, traffic_load), step)
+
+    def _render_while_saving(self, frames, saver: ThreadPoolExecutor):
+        """Like render for every frame, but each image is saved by saver while the next one is drawn"""
+        pending_save = None
+        for step, max_load, traffic_load in frames:
+            self.logger.info("Drawing data of step nr %d", step)
+            street_network_image = self.draw(max_load, traffic_load)
+            # at most one image waits to be saved, so only two images are in memory at once
+            if pending_save is not None:
+                yield pending_save.result()
+            pending_save = saver.submit(self.save_image, street_network_image, step)
+        if pending_save is not None:
+            yield pending_save.result()
+
+    def save_image(self, street_network_image: Image, step: int) -> str:
+        """Save the image of a step to renders_dir and return its path"""
+        image_path = f"{self.renders_dir}{self.mode.lower()}_{step}.png"
+        self.logger.info("Saving image to disk (%s)", image_path)
+        # the images are large, the lowest compression level saves them several times faster for slightly bigger files
+        street_network_image.save(image_path, optimize=False, compress_level=1)
+        return image_path
+
+    def draw(self, max_load: int, traffic_load: np.ndarray) -> Image:
+        left, upper, right, lower = self.canvas_box
+        if self._canvas is None:
+            self._canvas = np.empty((lower - upper, right - left, 4), dtype=np.uint8)
+        canvas = self._canvas
+        canvas[:, :] = (0, 0, 0, 255)
+        values = self.street_values(max_load, traffic_load)
+        # the street drawn last of the two between the same nodes shows the sum of both
+        has_opposite_street = self.opposite_streets >= 0
+        values[has_opposite_street] += values[self.opposite_streets[has_opposite_street]]
+
+        # lines are 1 pixel wide, max_speed / 50 looks bad for motorways
+        draw_lines(canvas, self.street_starts - (left, upper), self.street_ends - (left, upper),
+                   self.values_to_colors(values))
+        # the image shares the memory of the canvas, which is fine as _image_finalize copies it into a new image
+        street_network_image = Image.frombuffer("RGBA", (canvas.shape[1], canvas.shape[0]), canvas, "raw", "RGBA", 0, 1)
 
         self.logger.info("Finalizing Image")
         street_network_image = self._image_finalize(street_network_image, max_load)
         return street_network_image
 
+    def street_values(self, max_load: int, traffic_load: np.ndarray) -> np.ndarray:
+        """
+        Calculate what is displayed for every street according to self.mode, scaled to between 0 and 1
+
+        Args:
+          max_load: highest traffic load per lane, displayed as 1 in mode TRAFFIC_LOAD
+          traffic_load: traffic load of every street, by street index
+
+        Returns:
+            Array of the values of all streets, by street index
+        """
+        street_values = self._STREET_VALUE_FUNCTIONS.get(self.mode)
+        if street_values is None:
+            return np.zeros(len(self.lengths))
+        return street_values(self, max_load, traffic_load)
+
+    # one function per mode, each only uses the street attributes its mode displays
+
+    def _traffic_load_values(self, max_load: int, traffic_load: np.ndarray) -> np.ndarray:
+        return (traffic_load / self.numbers_of_lanes / max_load) ** (1 / 2)  # Sqrt for better visibility
+
+    def _max_speed_values(self, max_load: int, traffic_load: np.ndarray) -> np.ndarray:
+        return np.minimum(1.0, self.max_speeds / 140)
+
+    def _ideal_speed_values(self, max_load: int, traffic_load: np.ndarray) -> np.ndarray:
+        return np.minimum(1.0, self.ideal_speeds / 140)
+
+    def _actual_speed_values(self, max_load: int, traffic_load: np.ndarray) -> np.ndarray:
+        actual_speeds = calculate_driving_speed(self.lengths, self.max_speeds, traffic_load / self.numbers_of_lanes)
+        return np.minimum(1.0, actual_speeds / 140)
+
+    def _number_of_lanes_values(self, max_load: int, traffic_load: np.ndarray) -> np.ndarray:
+        return np.minimum(1.0, self.numbers_of_lanes / 5)
+
+    _STREET_VALUE_FUNCTIONS = {
+        "TRAFFIC_LOAD"   : _traffic_load_values,
+        "MAX_SPEED"      : _max_speed_values,
+        "IDEAL_SPEED"    : _ideal_speed_values,
+        "ACTUAL_SPEED"   : _actual_speed_values,
+        "NUMBER_OF_LANES": _number_of_lanes_values,
+    }
+
     def value_to_color(self, value: float):
         value = min(1.0, max(0.0, value))
-        if self.color_mode == 'MONOCHROME':
-            brightness = min(255, int(15 + 240 * value))
-            return brightness, brightness, brightness, 0
-        if self.color_mode == 'HEATMAP':
-            limit = 0
-            if value <= limit:  # almost black to blue
-                return "hsl(300,100%, 8%)"
-            else:  # blue to red
-                return "hsl(" + str(int(255 * (1 - (value - limit) / 1 - limit))) + ",100%," + str(
-                        30 + 20 * value) + "%)"
+        return tuple(self._color_table[ceil(value * (self.COLOR_TABLE_SIZE - 1))].tolist())
+
+    def values_to_colors(self, values: np.ndarray) -> np.ndarray:
+        """Like value_to_color, but for an array of values. Returns an array of RGBA colors"""
+        return self._color_table[self.quantize_values(values)]
+
+    def quantize_values(self, values: np.ndarray) -> np.ndarray:
+        """Turn values between 0 and 1 into indices of self._color_table, as uint8 array"""
+        return np.ceil(np.clip(values, 0.0, 1.0) * (self.COLOR_TABLE_SIZE - 1)).astype(np.uint8)
 
     def _image_finalize(self, street_network_image: Image, max_load: int) -> Image:
         """
-        Take the current street network and make it pretty. Crop, add legend and disclaimer, that the source of all
-        data is OpenStreetMaps.
+        Take the current street network and make it pretty. Add legend and disclaimer, that the source of all data is
+        OpenStreetMaps.
 
         Args:
           street_network_image: Image:
@@ -215,8 +336,6 @@ class Visualization(object):
         Returns:
             Pretty PIL.Image version of the street_network_image
         """
-        street_network_image = self.auto_crop(street_network_image)
-
         white = (255, 255, 255, 0)
         black = (0, 0, 0, 0)
         padding = self.max_resolution[0] // 40
@@ -236,10 +355,13 @@ class Visualization(object):
             draw.rectangle(
                     [(border_width, border_width), (bar_outer_width - border_width, legend.size[1] - 1 - border_width)],
                     fill=black)
-            for y in range(bar_offset, legend.size[1] - bar_offset):
-                value = 1.0 * (y - bar_offset) / (legend.size[1] - 2 * bar_offset)
-                color = self.value_to_color(1.0 - value)  # highest value at the top
-                draw.line([(bar_offset, y), (bar_offset + bar_inner_width, y)], fill=color)
+            bar_height = legend.size[1] - 2 * bar_offset
+            if bar_height > 0:
+                values = 1.0 - np.arange(bar_height) / bar_height  # highest value at the top
+                # every row of the bar has the same color from x = bar_offset to bar_offset + bar_inner_width
+                bar = np.broadcast_to(self.values_to_colors(values)[:, np.newaxis],
+                                      (bar_height, bar_inner_width + 1, 4))
+                legend.paste(Image.fromarray(np.ascontiguousarray(bar), "RGBA"), (bar_offset, bar_offset))
             if self.mode == 'TRAFFIC_LOAD':
                 top_text = str(round(max_load, 1)) + " cars gone through per lane"
                 bottom_text = "0 cars gone through"
@@ -286,10 +408,64 @@ class Visualization(object):
         Returns:
             Cropped version of the given Image
         """
-        empty = Image.new("RGBA", image.size, (0, 0, 0))
-        difference = ImageChops.difference(image, empty)
-        bbox = difference.getbbox()
-        return image.crop(bbox)
+        pixels = np.asarray(image)
+        # black edges are opaque black if the image has an alpha channel
+        not_black = (pixels != (0, 0, 0, 255)[:pixels.shape[2]]).any(axis=2)
+        rows = np.flatnonzero(not_black.any(axis=1))
+        columns = np.flatnonzero(not_black.any(axis=0))
+        if rows.size == 0:
+            return image.copy()
+        return image.crop((columns[0], rows[0], columns[-1] + 1, rows[-1] + 1))
+
+
+# Visualization used by the process rendering frames, set by _init_renderer
+_renderer = dict()
+
+
+def _init_renderer(visualization, log_queue):
+    # the log handlers inherited from the parent would put records into a queue no thread of this process reads
+    logger.init_worker_logging(log_queue)
+    _renderer["visualization"] = visualization
+
+
+def _render_frame(frame):
+    """Draw and save one frame, given as (step, max_load, traffic_load), returns the path of the image"""
+    return _renderer["visualization"].render(*frame)
+
+
+def draw_lines(canvas: np.ndarray, starts: np.ndarray, ends: np.ndarray, colors: np.ndarray):
+    """
+    Draw 1 pixel wide lines onto an image array, pixel by pixel the same as one ImageDraw.line call per line would
+
+    Args:
+      canvas: (height, width, 4) array of RGBA pixels to draw on
+      starts: (number of lines, 2) array of the x and y coordinates the lines start at
+      ends: (number of lines, 2) array of the x and y coordinates the lines end at
+      colors: (number of lines, 4) array of the RGBA colors of the lines, later lines are drawn over earlier ones
+    """
+    # like PIL, cut coordinates off to whole pixels
+    x0, y0 = starts.astype(np.int64).T
+    x1, y1 = ends.astype(np.int64).T
+    dx = np.abs(x1 - x0)
+    dy = np.abs(y1 - y0)
+    # Bresenham's algorithm sets one pixel per step along the longer axis, including both ends of the line
+    number_of_pixels = np.maximum(dx, dy) + 1
+    line = np.repeat(np.arange(len(number_of_pixels)), number_of_pixels)
+    step = np.arange(line.size) - np.repeat(np.cumsum(number_of_pixels) - number_of_pixels, number_of_pixels)
+    dx, dy = dx[line], dy[line]
+    horizontal = dx > dy
+    # along the shorter axis it moves to the closest pixel, going further on ties
+    x_offset = np.where(horizontal, step, (2 * dx * step + dy) // np.maximum(2 * dy, 1))
+    y_offset = np.where(horizontal, (2 * dy * step + dx) // np.maximum(2 * dx, 1), step)
+    x = x0[line] + np.where((x1 < x0)[line], -x_offset, x_offset)
+    y = y0[line] + np.where((y1 < y0)[line], -y_offset, y_offset)
+
+    # pixels outside of the canvas are skipped, for pixels set several times the last line drawn wins
+    height, width = canvas.shape[:2]
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    pixels = (y * width + x)[inside][::-1]
+    pixels, last = np.unique(pixels, return_index=True)
+    canvas.reshape(-1, canvas.shape[2])[pixels] = colors[line[inside][::-1][last]]
 
 
 if __name__ == "__main__":